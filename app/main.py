@@ -4,24 +4,44 @@ FastAPI application for PDF Toolbox.
 Provides endpoints for merging, deleting pages, and extracting pages from PDFs.
 """
 
+import asyncio
+import functools
 import logging
 import os
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
-from typing import List
+from typing import BinaryIO, List
 
 from fastapi import FastAPI, File, Form, HTTPException, UploadFile, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response, StreamingResponse
+from fastapi.responses import FileResponse, JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
-
-from .pagespec import PageSpecError
-from .pdf_ops import InvalidPDFError, PDFError, merge_pdfs, sanitize_filename
+from starlette.background import BackgroundTask
+
+from .pagespec import PageSpecError, check_pagespec_syntax
+from .pdf_ops import (
+    InvalidPDFError,
+    PDFError,
+    delete_pages,
+    extract_pages,
+    merge_pdfs,
+    sanitize_filename,
+)
 
 # Configuration
 MAX_FILE_SIZE = 100 * 1024 * 1024  # 100 MB
 MAX_MERGE_FILES = 20
 REQUEST_TIMEOUT = 300  # 5 minutes
+PDF_WORKERS = min(8, os.cpu_count() or 1)  # Concurrent pikepdf operations
+MULTIPART_OVERHEAD = 1024 * 1024  # Allowance for form fields and boundaries
+
+# Maximum request body size per upload endpoint
+MAX_BODY_SIZES = {
+    "/api/merge": MAX_MERGE_FILES * MAX_FILE_SIZE + MULTIPART_OVERHEAD,
+    "/api/delete-pages": MAX_FILE_SIZE + MULTIPART_OVERHEAD,
+    "/api/extract-pages": MAX_FILE_SIZE + MULTIPART_OVERHEAD,
+}
 
 # Configure logging
 logging.basicConfig(
@@ -30,13 +50,20 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# pikepdf calls block (qpdf releases the GIL), so run them off the event loop
+# on a bounded pool to keep concurrent requests from stalling each other
+pdf_executor = ThreadPoolExecutor(max_workers=PDF_WORKERS, thread_name_prefix="pdf")
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Lifespan context manager for startup and shutdown events."""
     logger.info("PDF Toolbox starting up...")
+    await init_rate_limiter()
     yield
     logger.info("PDF Toolbox shutting down...")
+    await close_rate_limiter()
+    pdf_executor.shutdown(wait=True)
 
 
 app = FastAPI(
@@ -46,6 +73,61 @@ app = FastAPI(
     lifespan=lifespan,
 )
 
+class BodySizeLimitMiddleware:
+    """
+    Reject oversized uploads while the body is still being received.
+
+    FastAPI parses the whole multipart body before the endpoint runs, so the
+    per-file check in validate_upload_file alone would still accept and spool
+    an arbitrarily large request first.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in MAX_BODY_SIZES:
+            await self.app(scope, receive, send)
+            return
+
+        limit = MAX_BODY_SIZES[scope["path"]]
+        detail = (
+            f"Request too large. Maximum file size is {MAX_FILE_SIZE // (1024*1024)} MB"
+        )
+
+        # Fail fast on the declared length
+        for name, value in scope["headers"]:
+            if name == b"content-length" and value.isdigit() and int(value) > limit:
+                response = JSONResponse(
+                    status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                    content={"detail": detail},
+                )
+                await response(scope, receive, send)
+                return
+
+        # Enforce the limit on what is actually received (e.g. chunked bodies)
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise HTTPException(
+                        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                        detail=detail,
+                    )
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+# Registered before CORSMiddleware so CORS stays outermost and early 413
+# responses still carry CORS headers
+app.add_middleware(BodySizeLimitMiddleware)
+
+
 # CORS - enable for all origins in production if needed, or restrict to your domain
 # For same-origin deployment, CORS is not strictly needed
 app.add_middleware(
@@ -57,28 +139,104 @@ app.add_middleware(
 )
 
 
-# Rate limiting - simple in-memory tracker
-# For production with multiple workers, use Redis or similar
-from collections import defaultdict
+# Rate limiting per client IP
+# Uses a Redis sorted set when REDIS_URL is set (shared across workers),
+# otherwise falls back to a bounded in-memory tracker
 from time import time
 
-rate_tracker = defaultdict(list)
+import redis.asyncio as redis
+from cachetools import TTLCache
+
+REDIS_URL = os.environ.get("REDIS_URL")
 RATE_LIMIT = 30  # requests per hour per IP
 RATE_WINDOW = 3600  # 1 hour in seconds
 
+# Atomically drop expired entries, count the rest and record this request.
+# ARGV: now (microseconds), window (seconds), limit
+RATE_LIMIT_SCRIPT = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], 0, now - window * 1000000)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now, ARGV[1])
+redis.call('EXPIRE', KEYS[1], window)
+return 1
+"""
+
+redis_client = None
+rate_limit_script = None
+RATE_TRACKER_SIZE = 100_000  # Max client IPs tracked in memory
+
+# In-memory fallback: a fixed-window request count per IP. Entries expire
+# RATE_WINDOW after the first request and the oldest are evicted when full.
+rate_tracker = TTLCache(maxsize=RATE_TRACKER_SIZE, ttl=RATE_WINDOW)
+
+# Clients already over the limit in the current second skip the Redis call
+exceeded_second = 0
+exceeded_ips = set()
+
+
+async def init_rate_limiter() -> None:
+    """Connect to Redis and register the rate limit script, if configured."""
+    global redis_client, rate_limit_script
+
+    if not REDIS_URL:
+        return
+
+    redis_client = redis.from_url(REDIS_URL)
+    # register_script uses EVALSHA and reloads the script if Redis lost it
+    rate_limit_script = redis_client.register_script(RATE_LIMIT_SCRIPT)
+    logger.info("Rate limiting backed by Redis")
+
+
+async def close_rate_limiter() -> None:
+    """Close the Redis connection, if any."""
+    if redis_client is not None:
+        await redis_client.aclose()
+
+
+async def check_rate_limit(client_ip: str) -> bool:
+    """Rate limiting check (sliding window in Redis, fixed window in memory)."""
+    global exceeded_second
 
-def check_rate_limit(client_ip: str) -> bool:
-    """Simple rate limiting check."""
     now = time()
-    # Clean old entries
-    rate_tracker[client_ip] = [
-        t for t in rate_tracker[client_ip] if now - t < RATE_WINDOW
-    ]
 
-    if len(rate_tracker[client_ip]) >= RATE_LIMIT:
+    if rate_limit_script is None:
+        count = rate_tracker.get(client_ip)
+        if count is None:
+            rate_tracker[client_ip] = [1]
+            return True
+
+        if count[0] >= RATE_LIMIT:
+            return False
+
+        # Mutate in place: reassigning would restart the entry's TTL
+        count[0] += 1
+        return True
+
+    second = int(now)
+    if second != exceeded_second:
+        exceeded_second = second
+        exceeded_ips.clear()
+    elif client_ip in exceeded_ips:
+        return False
+
+    try:
+        allowed = await rate_limit_script(
+            keys=[f"rl:{client_ip}"],
+            args=[int(now * 1_000_000), RATE_WINDOW, RATE_LIMIT],
+        )
+    except redis.RedisError as e:
+        # Fail open rather than rejecting every request while Redis is down
+        logger.warning(f"Rate limit check failed: {e}")
+        return True
+
+    if not allowed:
+        exceeded_ips.add(client_ip)
         return False
 
-    rate_tracker[client_ip].append(now)
     return True
 
 
@@ -96,25 +254,28 @@ def get_client_ip(request) -> str:
     return request.client.host if request.client else "unknown"
 
 
-async def validate_upload_file(file: UploadFile) -> bytes:
+async def validate_upload_file(file: UploadFile) -> BinaryIO:
     """
-    Validate and read an uploaded file.
+    Validate an uploaded file without reading it into memory.
 
     Returns:
-        File content as bytes
+        The underlying spooled file object, rewound to the start
 
     Raises:
         HTTPException: If file is invalid
     """
     # Check file size
-    content = await file.read()
-    if len(content) > MAX_FILE_SIZE:
+    file.file.seek(0, os.SEEK_END)
+    size = file.file.tell()
+    file.file.seek(0)
+
+    if size > MAX_FILE_SIZE:
         raise HTTPException(
             status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
             detail=f"File too large. Maximum size is {MAX_FILE_SIZE // (1024*1024)} MB",
         )
 
-    if len(content) == 0:
+    if size == 0:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Uploaded file is empty",
@@ -125,13 +286,50 @@ async def validate_upload_file(file: UploadFile) -> bytes:
         logger.warning(f"File {file.filename} has non-PDF MIME type: {file.content_type}")
 
     # Check magic bytes
-    if len(content) < 5 or content[:5] != b"%PDF-":
+    header = await file.read(5)
+    file.file.seek(0)
+    if header != b"%PDF-":
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="File is not a valid PDF (missing PDF header)",
         )
 
-    return content
+    return file.file
+
+
+async def run_pdf_operation(func, *args, **kwargs):
+    """Run a blocking PDF operation on the PDF worker pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        pdf_executor, functools.partial(func, *args, **kwargs)
+    )
+
+
+def create_output_file() -> BinaryIO:
+    """Create an on-disk temporary file for a generated PDF."""
+    return tempfile.NamedTemporaryFile(suffix=".pdf", delete=False)
+
+
+def discard_output_file(output: BinaryIO) -> None:
+    """Close and remove an output file that will not be sent."""
+    output.close()
+    os.unlink(output.name)
+
+
+def pdf_file_response(output: BinaryIO, filename: str) -> FileResponse:
+    """
+    Send a generated PDF from disk.
+
+    The output file is removed once the response has been sent.
+    """
+    output.close()
+
+    return FileResponse(
+        output.name,
+        media_type="application/pdf",
+        filename=filename,
+        background=BackgroundTask(os.unlink, output.name),
+    )
 
 
 @app.get("/health")
@@ -151,7 +349,7 @@ async def merge_pdfs_endpoint(files: List[UploadFile] = File(...)):
     try:
         # Note: Rate limiting is disabled for MVP
         # To enable, use Request object from FastAPI to get client IP
-        # if not check_rate_limit(client_ip):
+        # if not await check_rate_limit(client_ip):
         #     raise HTTPException(
         #         status_code=status.HTTP_429_TOO_MANY_REQUESTS,
         #         detail="Rate limit exceeded. Please try again later.",
@@ -170,66 +368,52 @@ async def merge_pdfs_endpoint(files: List[UploadFile] = File(...)):
                 detail=f"Maximum {MAX_MERGE_FILES} files allowed for merging",
             )
 
-        # Use temporary directory for processing
-        with tempfile.TemporaryDirectory() as temp_dir:
-            logger.info(f"Processing merge request with {len(files)} files in {temp_dir}")
+        logger.info(f"Processing merge request with {len(files)} files")
 
-            # Read and validate all files first
-            file_contents = []
-            original_filenames = []
+        if not all(file.filename for file in files):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="All files must have a filename",
+            )
 
-            for file in files:
-                if not file.filename:
-                    raise HTTPException(
-                        status_code=status.HTTP_400_BAD_REQUEST,
-                        detail="All files must have a filename",
-                    )
+        original_filenames = [file.filename for file in files]
 
-                content = await validate_upload_file(file)
-                file_contents.append(content)
-                original_filenames.append(file.filename)
-
-            # Write to temp files for pikepdf
-            temp_files = []
-            try:
-                for i, content in enumerate(file_contents):
-                    temp_path = os.path.join(temp_dir, f"input_{i}.pdf")
-                    with open(temp_path, "wb") as f:
-                        f.write(content)
-                    temp_files.append(open(temp_path, "rb"))
-
-                # Perform merge
-                result_bytes = merge_pdfs(temp_files)
-
-                # Generate output filename from first input
-                base_name = sanitize_filename(original_filenames[0])
-                output_filename = base_name.replace(".pdf", "-merged.pdf")
-
-                # Clean up temp file handles
-                for tf in temp_files:
-                    tf.close()
-
-                # Return streaming response
-                return StreamingResponse(
-                    iter([result_bytes]),
-                    media_type="application/pdf",
-                    headers={
-                        "Content-Disposition": f'attachment; filename="{output_filename}"',
-                        "Content-Length": str(len(result_bytes)),
-                    },
-                )
+        # Validate all files first, concurrently
+        input_files = await asyncio.gather(
+            *(validate_upload_file(file) for file in files)
+        )
 
-            except PDFError as e:
-                raise HTTPException(
-                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-                    detail=str(e),
-                )
-            except Exception as e:
-                logger.error(f"Unexpected error during merge: {e}")
-                raise HTTPException(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    detail="An error occurred while merging PDFs",
-                )
+        output = create_output_file()
+        try:
+            # Perform merge directly on the uploaded files
+            await run_pdf_operation(
+                merge_pdfs, input_files, output, trusted=True, timeout=REQUEST_TIMEOUT
+            )
+
+            # Generate output filename from first input
+            base_name = sanitize_filename(original_filenames[0])
+            output_filename = base_name.replace(".pdf", "-merged.pdf")
+
+            # Return the PDF from disk
+            return pdf_file_response(output, output_filename)
+
+        except PDFError as e:
+            discard_output_file(output)
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=str(e),
+            )
+        except Exception as e:
+            discard_output_file(output)
+            logger.error(f"Unexpected error during merge: {e}")
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="An error occurred while merging PDFs",
+            )
+        except BaseException:
+            # Any other failure or cancellation: don't leave the file behind
+            discard_output_file(output)
+            raise
 
     except HTTPException:
         raise
@@ -260,48 +444,48 @@ async def delete_pages_endpoint(
                 detail="File must have a filename",
             )
 
-        content = await validate_upload_file(file)
-
-        # Use temporary directory for processing
-        with tempfile.TemporaryDirectory() as temp_dir:
-            logger.info(f"Processing delete-pages request in {temp_dir}")
-
-            # Write to temp file
-            temp_path = os.path.join(temp_dir, "input.pdf")
-            with open(temp_path, "wb") as f:
-                f.write(content)
+        # Reject malformed page specs before touching the upload
+        try:
+            check_pagespec_syntax(pages_spec)
+        except PageSpecError as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=str(e),
+            )
 
-            try:
-                # Perform page deletion
-                with open(temp_path, "rb") as input_file:
-                    from .pdf_ops import delete_pages
+        input_file = await validate_upload_file(file)
+        logger.info("Processing delete-pages request")
 
-                    result_bytes = delete_pages(input_file, pages_spec)
+        output = create_output_file()
+        try:
+            # Perform page deletion
+            await run_pdf_operation(
+                delete_pages, input_file, pages_spec, output, trusted=True
+            )
 
-                # Generate output filename
-                base_name = sanitize_filename(file.filename)
-                output_filename = base_name.replace(".pdf", "-pages-deleted.pdf")
+            # Generate output filename
+            base_name = sanitize_filename(file.filename)
+            output_filename = base_name.replace(".pdf", "-pages-deleted.pdf")
 
-                # Return streaming response
-                return StreamingResponse(
-                    iter([result_bytes]),
-                    media_type="application/pdf",
-                    headers={
-                        "Content-Disposition": f'attachment; filename="{output_filename}"',
-                        "Content-Length": str(len(result_bytes)),
-                    },
-                )
+            # Return the PDF from disk
+            return pdf_file_response(output, output_filename)
 
-            except PageSpecError as e:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail=str(e),
-                )
-            except PDFError as e:
-                raise HTTPException(
-                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-                    detail=str(e),
-                )
+        except PageSpecError as e:
+            discard_output_file(output)
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=str(e),
+            )
+        except PDFError as e:
+            discard_output_file(output)
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=str(e),
+            )
+        except BaseException:
+            # Any other failure or cancellation: don't leave the file behind
+            discard_output_file(output)
+            raise
 
     except HTTPException:
         raise
@@ -332,48 +516,48 @@ async def extract_pages_endpoint(
                 detail="File must have a filename",
             )
 
-        content = await validate_upload_file(file)
-
-        # Use temporary directory for processing
-        with tempfile.TemporaryDirectory() as temp_dir:
-            logger.info(f"Processing extract-pages request in {temp_dir}")
-
-            # Write to temp file
-            temp_path = os.path.join(temp_dir, "input.pdf")
-            with open(temp_path, "wb") as f:
-                f.write(content)
+        # Reject malformed page specs before touching the upload
+        try:
+            check_pagespec_syntax(pages_spec)
+        except PageSpecError as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=str(e),
+            )
 
-            try:
-                # Perform page extraction
-                with open(temp_path, "rb") as input_file:
-                    from .pdf_ops import extract_pages
+        input_file = await validate_upload_file(file)
+        logger.info("Processing extract-pages request")
 
-                    result_bytes = extract_pages(input_file, pages_spec)
+        output = create_output_file()
+        try:
+            # Perform page extraction
+            await run_pdf_operation(
+                extract_pages, input_file, pages_spec, output, trusted=True
+            )
 
-                # Generate output filename
-                base_name = sanitize_filename(file.filename)
-                output_filename = base_name.replace(".pdf", "-extracted.pdf")
+            # Generate output filename
+            base_name = sanitize_filename(file.filename)
+            output_filename = base_name.replace(".pdf", "-extracted.pdf")
 
-                # Return streaming response
-                return StreamingResponse(
-                    iter([result_bytes]),
-                    media_type="application/pdf",
-                    headers={
-                        "Content-Disposition": f'attachment; filename="{output_filename}"',
-                        "Content-Length": str(len(result_bytes)),
-                    },
-                )
+            # Return the PDF from disk
+            return pdf_file_response(output, output_filename)
 
-            except PageSpecError as e:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail=str(e),
-                )
-            except PDFError as e:
-                raise HTTPException(
-                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-                    detail=str(e),
-                )
+        except PageSpecError as e:
+            discard_output_file(output)
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=str(e),
+            )
+        except PDFError as e:
+            discard_output_file(output)
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=str(e),
+            )
+        except BaseException:
+            # Any other failure or cancellation: don't leave the file behind
+            discard_output_file(output)
+            raise
 
     except HTTPException:
         raise
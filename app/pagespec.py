@@ -10,6 +10,20 @@ Accepts formats like:
 Returns sorted list of unique 1-based page numbers.
 """
 
+import re
+from typing import NoReturn
+
+# A single token: "N" or "N-M", with optional surrounding whitespace.
+# Page numbers are capped at 9 digits so int() never hits the
+# integer string conversion limit.
+_TOKEN_RE = re.compile(r"\s*(\d{1,9})(?:\s*-\s*(\d{1,9}))?\s*\Z")
+
+# A whole specification: comma-separated tokens, empty tokens allowed
+_PAGESPEC_RE = re.compile(
+    r"\s*(?:\d{1,9}(?:\s*-\s*\d{1,9})?\s*)?"
+    r"(?:,\s*(?:\d{1,9}(?:\s*-\s*\d{1,9})?\s*)?)*\Z"
+)
+
 
 class PageSpecError(Exception):
     """Raised when page specification is invalid."""
@@ -17,6 +31,42 @@ class PageSpecError(Exception):
     pass
 
 
+def _raise_token_error(part: str) -> NoReturn:
+    """Raise a PageSpecError describing why a token is malformed."""
+    part = part.strip()
+    if "-" not in part:
+        raise PageSpecError(f"Invalid page number: '{part}'")
+
+    range_parts = part.split("-")
+    if len(range_parts) != 2 or not all(p.strip() for p in range_parts):
+        raise PageSpecError(f"Invalid range format: '{part}'")
+    raise PageSpecError(f"Invalid numbers in range: '{part}'")
+
+
+def check_pagespec_syntax(spec: str) -> None:
+    """
+    Check that a pages specification is well-formed, without page bounds.
+
+    This is cheap enough to run before the PDF is opened, so malformed
+    specifications are rejected without paying for that.
+
+    Raises:
+        PageSpecError: If specification is empty or malformed
+    """
+    if not spec or not spec.strip():
+        raise PageSpecError("Page specification cannot be empty")
+
+    if _PAGESPEC_RE.match(spec):
+        return
+
+    # Report the first offending token the same way parse_pagespec does
+    for part in spec.split(","):
+        if part and not part.isspace() and not _TOKEN_RE.match(part):
+            _raise_token_error(part)
+
+    raise PageSpecError(f"Invalid page specification: '{spec.strip()}'")
+
+
 def parse_pagespec(spec: str, total_pages: int) -> list[int]:
     """
     Parse a pages specification string and return a list of 1-based page numbers.
@@ -34,65 +84,55 @@ def parse_pagespec(spec: str, total_pages: int) -> list[int]:
     if not spec or not spec.strip():
         raise PageSpecError("Page specification cannot be empty")
 
-    spec = spec.strip()
     pages = set()
 
     # Split by comma first
-    parts = spec.split(",")
-    for part in parts:
-        part = part.strip()
-        if not part:
+    for part in spec.split(","):
+        if not part or part.isspace():
             continue
 
-        # Check if it's a range
-        if "-" in part:
-            range_parts = part.split("-")
-            if len(range_parts) != 2:
-                raise PageSpecError(f"Invalid range format: '{part}'")
+        match = _TOKEN_RE.match(part)
+        if match is None:
+            _raise_token_error(part)
+
+        start_str, end_str = match.groups()
+
+        if end_str is None:
+            # Single page
+            page = int(start_str)
 
-            try:
-                start_str = range_parts[0].strip()
-                end_str = range_parts[1].strip()
+            if page <= 0:
+                raise PageSpecError(f"Page number must be positive: {page}")
 
-                if not start_str or not end_str:
-                    raise PageSpecError(f"Invalid range format: '{part}'")
+            if page > total_pages:
+                raise PageSpecError(
+                    f"Page {page} exceeds total pages ({total_pages})"
+                )
 
-                start = int(start_str)
-                end = int(end_str)
-            except ValueError:
-                raise PageSpecError(f"Invalid numbers in range: '{part}'")
+            pages.add(page)
+        else:
+            # Range
+            start = int(start_str)
+            end = int(end_str)
 
             if start <= 0 or end <= 0:
-                raise PageSpecError(f"Page numbers must be positive (found in '{part}')")
+                raise PageSpecError(
+                    f"Page numbers must be positive (found in '{part.strip()}')"
+                )
 
             if start > end:
                 raise PageSpecError(
                     f"Range start cannot be greater than end: {start}-{end}"
                 )
 
-            # Add all pages in the range
-            for page in range(start, end + 1):
-                if page > total_pages:
-                    raise PageSpecError(
-                        f"Page {page} exceeds total pages ({total_pages})"
-                    )
-                pages.add(page)
-        else:
-            # Single page
-            try:
-                page = int(part)
-            except ValueError:
-                raise PageSpecError(f"Invalid page number: '{part}'")
-
-            if page <= 0:
-                raise PageSpecError(f"Page number must be positive: {page}")
-
-            if page > total_pages:
+            if end > total_pages:
+                first_missing = max(start, total_pages + 1)
                 raise PageSpecError(
-                    f"Page {page} exceeds total pages ({total_pages})"
+                    f"Page {first_missing} exceeds total pages ({total_pages})"
                 )
 
-            pages.add(page)
+            # Add all pages in the range
+            pages.update(range(start, end + 1))
 
     if not pages:
         raise PageSpecError("No valid pages found in specification")
@@ -121,14 +161,21 @@ def pages_to_keep(spec: str, total_pages: int, mode: str) -> list[int]:
         # For extract, keep only the specified pages in order
         return specified_pages
     elif mode == "delete":
-        # For delete, keep all pages EXCEPT the specified ones
-        all_pages = set(range(1, total_pages + 1))
-        specified_set = set(specified_pages)
-        keep_pages = all_pages - specified_set
+        # For delete, keep all pages EXCEPT the specified ones.
+        # specified_pages is sorted, so one merge-style walk yields the
+        # complement already in order.
+        keep_pages = []
+        j = 0
+        num_specified = len(specified_pages)
+        for page in range(1, total_pages + 1):
+            if j < num_specified and specified_pages[j] == page:
+                j += 1
+            else:
+                keep_pages.append(page)
 
         if not keep_pages:
             raise PageSpecError("Cannot delete all pages from PDF")
 
-        return sorted(keep_pages)
+        return keep_pages
     else:
         raise ValueError(f"Invalid mode: {mode}")
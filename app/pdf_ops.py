@@ -6,7 +6,12 @@ Provides merge, delete pages, and extract pages functionality.
 
 import io
 import logging
-from typing import BinaryIO, List
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+from typing import BinaryIO, List, Optional
 
 import pikepdf
 
@@ -14,6 +19,21 @@ from .pagespec import PageSpecError, pages_to_keep
 
 logger = logging.getLogger(__name__)
 
+# Save options for the fast path: keep existing object streams and copy
+# content streams as-is instead of decoding and recompressing them
+SAVE_OPTIONS = {
+    "object_stream_mode": pikepdf.ObjectStreamMode.preserve,
+    "stream_decode_level": pikepdf.StreamDecodeLevel.none,
+    "compress_streams": False,
+}
+
+# Merges of more files than this go through the qpdf CLI in one process
+QPDF_MERGE_THRESHOLD = 8
+QPDF_PATH = shutil.which("qpdf")
+
+# Characters not allowed in download filenames
+_UNSAFE_CHARS = re.compile(r"[^\w\s\-.]")
+
 
 class PDFError(Exception):
     """Base exception for PDF operation errors."""
@@ -40,16 +60,20 @@ def is_valid_pdf(file_data: bytes) -> bool:
     return file_data[:5] == b"%PDF-"
 
 
-def open_pdf(source) -> pikepdf.Pdf:
+def open_pdf(source, trusted: bool = False) -> pikepdf.Pdf:
     """
     Open a PDF from a file-like object or path.
 
+    Args:
+        source: File-like object or path
+        trusted: Skip the magic byte check when the caller has already done it
+
     Raises:
         InvalidPDFError: If the file is not a valid PDF
     """
     try:
         # For file-like objects, read and check bytes first
-        if hasattr(source, "read"):
+        if not trusted and hasattr(source, "read"):
             data = source.read(1024)  # Read first 1KB for validation
             source.seek(0)  # Reset position
 
@@ -65,16 +89,101 @@ def open_pdf(source) -> pikepdf.Pdf:
         raise InvalidPDFError(f"Error opening PDF: {str(e)}")
 
 
-def merge_pdfs(files: List[BinaryIO], output_filename: str = "merged.pdf") -> bytes:
+def _merge_with_qpdf(
+    files: List[BinaryIO], output: BinaryIO, timeout: Optional[float] = None
+) -> None:
+    """
+    Merge PDFs with a single `qpdf --empty --pages ...` invocation.
+
+    Inputs backed by a real file are passed to qpdf as /dev/fd/N; anything
+    else is copied to a temporary file first. If the output is a file on
+    disk, qpdf writes to it directly.
+
+    Raises:
+        PDFError: If qpdf fails or times out
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        input_paths = []
+        pass_fds = []
+
+        for i, file_obj in enumerate(files):
+            file_obj.seek(0)
+            try:
+                fd = file_obj.fileno()
+            except (AttributeError, io.UnsupportedOperation):
+                path = os.path.join(temp_dir, f"input_{i}.pdf")
+                with open(path, "wb") as f:
+                    shutil.copyfileobj(file_obj, f)
+                input_paths.append(path)
+            else:
+                pass_fds.append(fd)
+                input_paths.append(f"/dev/fd/{fd}")
+
+        # Let qpdf write straight into the output file when it has a path,
+        # instead of writing a temporary copy and copying it over
+        output_path = getattr(output, "name", None)
+        write_in_place = isinstance(output_path, str) and os.path.isfile(output_path)
+        if not write_in_place:
+            output_path = os.path.join(temp_dir, "merged.pdf")
+        command = [
+            QPDF_PATH,
+            "--empty",
+            "--object-streams=preserve",
+            "--decode-level=none",
+            "--compress-streams=n",
+            "--pages",
+            *input_paths,
+            "--",
+            output_path,
+        ]
+
+        try:
+            result = subprocess.run(
+                command, capture_output=True, pass_fds=pass_fds, timeout=timeout
+            )
+        except subprocess.TimeoutExpired:
+            raise PDFError("Merging PDFs timed out")
+
+        # Exit code 3 means the merge succeeded with warnings
+        if result.returncode not in (0, 3):
+            message = result.stderr.decode(errors="replace").strip()
+            # Refer to inputs the same way the pikepdf path does
+            numbered = sorted(enumerate(input_paths), key=lambda p: -len(p[1]))
+            for i, path in numbered:
+                message = message.replace(path, f"File {i + 1}")
+            logger.error(f"qpdf merge failed: {message}")
+
+            # Keep qpdf's diagnostics in the log; tell the client which file
+            failed_file = re.search(r"File \d+", message)
+            if failed_file:
+                raise PDFError(
+                    f"Error merging PDFs: {failed_file.group()} is invalid or damaged"
+                )
+            raise PDFError("Error merging PDFs")
+
+        if not write_in_place:
+            with open(output_path, "rb") as f:
+                shutil.copyfileobj(f, output)
+
+    logger.info(f"Successfully merged {len(files)} PDFs with qpdf")
+
+
+def merge_pdfs(
+    files: List[BinaryIO],
+    output: BinaryIO,
+    output_filename: str = "merged.pdf",
+    trusted: bool = False,
+    timeout: Optional[float] = None,
+) -> None:
     """
     Merge multiple PDFs into a single PDF.
 
     Args:
         files: List of file-like objects containing PDF data
+        output: Writable file-like object that receives the merged PDF
         output_filename: Filename to use in the output
-
-    Returns:
-        Merged PDF as bytes
+        trusted: Inputs already passed the PDF header check
+        timeout: Time limit in seconds for the qpdf CLI path
 
     Raises:
         PDFError: If merge operation fails
@@ -82,53 +191,72 @@ def merge_pdfs(files: List[BinaryIO], output_filename: str = "merged.pdf") -> by
     if not files:
         raise PDFError("No files provided for merging")
 
+    # Large batches: let qpdf do the whole merge natively
+    if QPDF_PATH and len(files) > QPDF_MERGE_THRESHOLD:
+        if not trusted:
+            # Same header check open_pdf does on the pikepdf path
+            for i, file_obj in enumerate(files):
+                file_obj.seek(0)
+                header = file_obj.read(5)
+                file_obj.seek(0)
+                if not is_valid_pdf(header):
+                    raise PDFError(f"File {i + 1}: File is not a valid PDF")
+
+        _merge_with_qpdf(files, output, timeout=timeout)
+        return
+
     merged_pdf = pikepdf.Pdf.new()
+    # Sources stay open until the merged PDF is saved so qpdf can copy
+    # their objects lazily during the write
+    source_pdfs = []
 
-    for i, file_obj in enumerate(files):
-        try:
-            file_obj.seek(0)
-            source_pdf = open_pdf(file_obj)
+    try:
+        for i, file_obj in enumerate(files):
+            try:
+                file_obj.seek(0)
+                source_pdf = open_pdf(file_obj, trusted=trusted)
+                source_pdfs.append(source_pdf)
 
-            # Copy all pages from source to merged PDF
-            for page in source_pdf.pages:
-                merged_pdf.pages.append(page)
+                # Copy all pages from source to merged PDF in one call
+                merged_pdf.pages.extend(source_pdf.pages)
 
-            logger.info(f"Added PDF {i + 1} with {len(source_pdf.pages)} pages")
-            source_pdf.close()
+                logger.info(f"Added PDF {i + 1} with {len(source_pdf.pages)} pages")
 
-        except InvalidPDFError as e:
-            raise PDFError(f"File {i + 1}: {str(e)}")
-        except Exception as e:
-            logger.error(f"Error processing file {i + 1}: {e}")
-            raise PDFError(f"Error processing file {i + 1}: {str(e)}")
+            except InvalidPDFError as e:
+                raise PDFError(f"File {i + 1}: {str(e)}")
+            except Exception as e:
+                logger.error(f"Error processing file {i + 1}: {e}")
+                raise PDFError(f"Error processing file {i + 1}: {str(e)}")
 
-    # Save to bytes
-    output = io.BytesIO()
-    try:
-        merged_pdf.save(output)
-        logger.info(f"Successfully merged {len(files)} PDFs")
-    except Exception as e:
-        logger.error(f"Error saving merged PDF: {e}")
-        raise PDFError(f"Error saving merged PDF: {str(e)}")
+        # Save to the output stream
+        try:
+            merged_pdf.save(output, **SAVE_OPTIONS)
+            logger.info(f"Successfully merged {len(files)} PDFs")
+        except Exception as e:
+            logger.error(f"Error saving merged PDF: {e}")
+            raise PDFError(f"Error saving merged PDF: {str(e)}")
     finally:
         merged_pdf.close()
-
-    return output.getvalue()
+        for source_pdf in source_pdfs:
+            source_pdf.close()
 
 
 def delete_pages(
-    file: BinaryIO, pages_spec: str, output_filename: str = "modified.pdf"
-) -> bytes:
+    file: BinaryIO,
+    pages_spec: str,
+    output: BinaryIO,
+    output_filename: str = "modified.pdf",
+    trusted: bool = False,
+) -> None:
     """
     Delete specified pages from a PDF.
 
     Args:
         file: File-like object containing PDF data
         pages_spec: Page specification (e.g., "1,3-5,7")
+        output: Writable file-like object that receives the modified PDF
         output_filename: Filename to use in the output
-
-    Returns:
-        Modified PDF as bytes
+        trusted: Input already passed the PDF header check
 
     Raises:
         PDFError: If operation fails
@@ -136,7 +264,7 @@ def delete_pages(
     """
     try:
         file.seek(0)
-        source_pdf = open_pdf(file)
+        source_pdf = open_pdf(file, trusted=trusted)
         total_pages = len(source_pdf.pages)
 
         # Get pages to keep (inverse of delete)
@@ -144,18 +272,17 @@ def delete_pages(
 
         # Create new PDF with only the pages we want to keep
         output_pdf = pikepdf.Pdf.new()
-        for page_num in keep_pages:
-            # pikepdf uses 0-based indexing internally
-            output_pdf.pages.append(source_pdf.pages[page_num - 1])
+        # Look up the page list once; each .pages access builds a new one.
+        # pikepdf uses 0-based indexing internally
+        source_pages = source_pdf.pages
+        output_pdf.pages.extend([source_pages[i - 1] for i in keep_pages])
 
-        output = io.BytesIO()
-        output_pdf.save(output)
+        output_pdf.save(output, **SAVE_OPTIONS)
 
         source_pdf.close()
         output_pdf.close()
 
         logger.info(f"Deleted pages from PDF: kept {len(keep_pages)}/{total_pages} pages")
-        return output.getvalue()
 
     except PageSpecError:
         raise
@@ -167,18 +294,26 @@ def delete_pages(
 
 
 def extract_pages(
-    file: BinaryIO, pages_spec: str, output_filename: str = "extracted.pdf"
-) -> bytes:
+    file: BinaryIO,
+    pages_spec: str,
+    output: BinaryIO,
+    output_filename: str = "extracted.pdf",
+    trusted: bool = False,
+) -> None:
     """
     Extract specified pages from a PDF into a new PDF.
 
+    If every page is requested, the input bytes are copied to the output
+    unchanged instead of being rewritten (so SAVE_OPTIONS do not apply).
+    Encrypted input, and input qpdf had to repair on open, always goes
+    through the normal path, which writes an unencrypted, repaired copy.
+
     Args:
         file: File-like object containing PDF data
         pages_spec: Page specification (e.g., "1,3-5,7")
+        output: Writable file-like object that receives the new PDF
         output_filename: Filename to use in the output
-
-    Returns:
-        New PDF containing extracted pages as bytes
+        trusted: Input already passed the PDF header check
 
     Raises:
         PDFError: If operation fails
@@ -186,20 +321,33 @@ def extract_pages(
     """
     try:
         file.seek(0)
-        source_pdf = open_pdf(file)
+        source_pdf = open_pdf(file, trusted=trusted)
         total_pages = len(source_pdf.pages)
 
         # Get pages to extract
         extract_pages_list = pages_to_keep(pages_spec, total_pages, mode="extract")
 
+        # Extracting every page in order: the input already is the result,
+        # unless qpdf had to decrypt or repair it on open
+        if (
+            len(extract_pages_list) == total_pages
+            and not source_pdf.is_encrypted
+            and not source_pdf.get_warnings()
+        ):
+            source_pdf.close()
+            file.seek(0)
+            shutil.copyfileobj(file, output)
+            logger.info(f"Extracted all {total_pages} pages, returning input as-is")
+            return
+
         # Create new PDF with extracted pages
         output_pdf = pikepdf.Pdf.new()
-        for page_num in extract_pages_list:
-            # pikepdf uses 0-based indexing internally
-            output_pdf.pages.append(source_pdf.pages[page_num - 1])
+        # Look up the page list once; each .pages access builds a new one.
+        # pikepdf uses 0-based indexing internally
+        source_pages = source_pdf.pages
+        output_pdf.pages.extend([source_pages[i - 1] for i in extract_pages_list])
 
-        output = io.BytesIO()
-        output_pdf.save(output)
+        output_pdf.save(output, **SAVE_OPTIONS)
 
         source_pdf.close()
         output_pdf.close()
@@ -207,7 +355,6 @@ def extract_pages(
         logger.info(
             f"Extracted pages from PDF: {len(extract_pages_list)}/{total_pages} pages"
         )
-        return output.getvalue()
 
     except PageSpecError:
         raise
@@ -224,13 +371,11 @@ def sanitize_filename(filename: str) -> str:
 
     Keeps alphanumeric, hyphens, underscores, dots, and spaces.
     """
-    import re
-
     # Remove path components
     filename = filename.split("\\")[-1].split("/")[-1]
 
     # Replace non-safe characters with underscore
-    filename = re.sub(r'[^\w\s\-\.]', '_', filename)
+    filename = _UNSAFE_CHARS.sub('_', filename)
 
     # Remove leading/trailing dots and spaces
     filename = filename.strip('. ')
@@ -240,7 +385,7 @@ def sanitize_filename(filename: str) -> str:
         filename = "document.pdf"
 
     # Ensure it ends with .pdf
-    if not filename.lower().endswith('.pdf'):
+    if filename[-4:].lower() != '.pdf':
         filename += '.pdf'
 
     return filename